@@ -5,19 +5,30 @@ Generate an RSS 2.0 feed (docs/feed.xml) from an episode XML file and existing f
 Usage:
   python scripts/generate_feed.py
 
-This script uses only the Python standard library so it can run in GitHub Actions
-without installing extra packages.
+Requires lxml (see requirements.txt) for parsing and pretty-printing the feed.
 """
 from __future__ import annotations
 
-import glob
+import hashlib
 import os
-import re
 from datetime import datetime, timezone
 from email.utils import format_datetime
+from functools import lru_cache
 from pathlib import Path
-from xml.etree import ElementTree as ET
-from xml.dom import minidom, Node
+from types import MappingProxyType
+
+from lxml.etree import (
+    CDATA,
+    Element,
+    ElementTree,
+    SubElement,
+    XMLParser,
+    XMLSyntaxError,
+    _Element,
+    fromstring,
+    indent,
+    parse,
+)
 
 
 REPO_NAME = Path(__file__).resolve().parents[1].name
@@ -25,7 +36,27 @@ SITE_TITLE = "TechNewsDaily"
 SITE_LINK = "/"
 SITE_DESC = "Tech news and summaries — generated RSS feed"
 
+# Common RSS namespaces declared on newly created feeds
+NAMESPACES = MappingProxyType({
+    'itunes': 'http://www.itunes.com/dtds/podcast-1.0.dtd',
+    'content': 'http://purl.org/rss/1.0/modules/content/',
+    'atom': 'http://www.w3.org/2005/Atom',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'media': 'http://search.yahoo.com/mrss/',
+})
 
+# Shared parser for episode files. Whitespace-only text is dropped; the
+# merged feed is re-indented with indent() before it is written.
+_PARSER = XMLParser(remove_blank_text=True)
+
+# Parser for the existing feed; archived links keep their CDATA sections
+_FEED_PARSER = XMLParser(remove_blank_text=True, strip_cdata=False)
+
+# Entity prefixes that make an '&' well-formed XML
+_XML_ENTITIES = ("&amp;", "&lt;", "&gt;", "&quot;", "&apos;", "&#")
+
+
+@lru_cache(maxsize=4096)
 def iso_to_rfc2822(iso: str) -> str:
     # Parse ISO 8601 and output RFC 2822 for RSS pubDate
     dt = datetime.fromisoformat(iso)
@@ -37,77 +68,105 @@ def iso_to_rfc2822(iso: str) -> str:
 def get_latest_episode_file(data_dir: Path) -> Path | None:
     # Find all episode XML files and get the latest one by unix timestamp
     # Check both "episode-" and "eposide-" prefixes due to potential typo
-    episode_files = glob.glob(str(data_dir / "[e][p][io]s[io]de-*.xml"))
-    if not episode_files:
+    latest_ts, latest_file = -1, None
+    try:
+        entries = os.scandir(data_dir)
+    except FileNotFoundError:
         return None
-
-    # Extract unix timestamps and find the latest
-    latest_file = max(episode_files, key=lambda f: int(f.split("-")[-1].split(".")[0]))
-    return Path(latest_file)
-
-
-def merge_episode_into_feed(feed_file: Path, episode_file: Path) -> bytes:
-    # Define common RSS namespaces
-    NAMESPACES = {
-        'itunes': 'http://www.itunes.com/dtds/podcast-1.0.dtd',
-        'content': 'http://purl.org/rss/1.0/modules/content/',
-        'atom': 'http://www.w3.org/2005/Atom',
-        'dc': 'http://purl.org/dc/elements/1.1/',
-        'media': 'http://search.yahoo.com/mrss/',
-    }
-    
-    # Register namespaces to ensure consistent prefixes
-    for prefix, uri in NAMESPACES.items():
-        ET.register_namespace(prefix, uri)
-        
+    with entries:
+        for entry in entries:
+            name = entry.name
+            if not name.endswith(".xml"):
+                continue
+            if not name.startswith(("episode-", "eposide-")):
+                continue
+            try:
+                ts = int(name.rsplit("-", 1)[1][:-4])
+            except ValueError:
+                continue
+            if ts > latest_ts:
+                latest_ts, latest_file = ts, entry.path
+    return Path(latest_file) if latest_file else None
+
+
+def _has_bare_ampersand(text: str) -> bool:
+    pos = text.find("&")
+    while pos != -1:
+        if not text.startswith(_XML_ENTITIES, pos):
+            return True
+        pos = text.find("&", pos + 1)
+    return False
+
+
+def _fix_links(text: str) -> str:
+    # Wrap <link> contents holding a bare '&' in CDATA so the document parses.
+    # This is a single str.find scan, so large inputs cannot trigger regex
+    # backtracking. Links already containing CDATA are left untouched.
+    parts = []
+    pos = 0
+    while True:
+        start = text.find("<link>", pos)
+        if start == -1:
+            break
+        start += len("<link>")
+        end = text.find("</link>", start)
+        if end == -1:
+            break
+        inner = text[start:end]
+        if "<![CDATA[" not in inner and _has_bare_ampersand(inner):
+            inner = f"<![CDATA[{inner}]]>"
+        parts.append(text[pos:start])
+        parts.append(inner)
+        pos = end
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+def _item_keys(item: _Element) -> tuple[str, str]:
+    # guid and link of an item, empty when missing
+    return item.findtext("guid") or "", item.findtext("link") or ""
+
+
+def _parse_feed(feed_file: Path) -> tuple[_Element, set[str]]:
+    # Parse the existing feed and index the guids and links of the channel's
+    # <item> elements, so a single lookup catches a duplicate by either one
+    rss = parse(str(feed_file), parser=_FEED_PARSER).getroot()
+    index = set()
+    for item in rss.find("channel").iterchildren("item"):
+        index.update(key for key in _item_keys(item) if key)
+    return rss, index
+
+
+def merge_episode_into_feed(feed_file: Path, episode_data: bytes, out_path: Path) -> None:
     # If feed file doesn't exist, create a new one with necessary namespaces
     if not feed_file.exists():
-        rss = ET.Element("rss", version="2.0", attrib=NAMESPACES)
-        channel = ET.SubElement(rss, "channel")
-        ET.SubElement(channel, "title").text = SITE_TITLE
-        ET.SubElement(channel, "link").text = SITE_LINK
-        ET.SubElement(channel, "description").text = SITE_DESC
-        ET.SubElement(channel, "language").text = "en-us"
+        rss = Element("rss", nsmap=NAMESPACES, version="2.0")
+        channel = SubElement(rss, "channel")
+        SubElement(channel, "title").text = SITE_TITLE
+        SubElement(channel, "link").text = SITE_LINK
+        SubElement(channel, "description").text = SITE_DESC
+        SubElement(channel, "language").text = "en-us"
+        index = set()
     else:
-        # Parse existing feed while preserving namespaces
-        parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
-        rss = ET.parse(feed_file, parser=parser).getroot()
-        # Preserve existing namespaces from the root element
-        for key, value in rss.attrib.items():
-            if key.startswith('xmlns:'):
-                prefix = key.split(':')[1]
-                ET.register_namespace(prefix, value)
+        # lxml keeps the original namespace prefixes (nsmap) and comments
+        rss, index = _parse_feed(feed_file)
         channel = rss.find("channel")
 
     # Update build date
     build_date = channel.find("lastBuildDate")
     if build_date is None:
-        build_date = ET.SubElement(channel, "lastBuildDate")
+        build_date = SubElement(channel, "lastBuildDate")
     build_date.text = format_datetime(datetime.now(timezone.utc))
 
-    # Parse new episode from the episode XML file directly. Some sources may
+    # Parse the new episode from the raw episode XML. Some sources may
     # produce unescaped '&' characters inside <link> which makes the XML
-    # not well-formed. Try a normal parse first; on failure, read the file as
-    # text and wrap link contents that contain '&' in CDATA, then parse.
+    # not well-formed. Try a normal parse first; on failure, wrap link
+    # contents that contain '&' in CDATA and parse the same buffer again.
     try:
-        episode_tree = ET.parse(episode_file)
-    except ET.ParseError:
-        text = episode_file.read_text(encoding="utf-8")
-
-        # Replace <link>...&...</link> with CDATA-wrapped content to make it
-        # well-formed for parsing. Do not modify if already contains CDATA.
-        def _wrap_link_cdata(m: re.Match) -> str:
-            open_tag, inner, close_tag = m.group(1), m.group(2), m.group(3)
-            if "<![CDATA[" in inner:
-                return f"{open_tag}{inner}{close_tag}"
-            return f"{open_tag}<![CDATA[{inner}]]>{close_tag}"
-
-        pattern = re.compile(r"(<link>)(.*?&.*?)(</link>)", flags=re.DOTALL)
-        fixed = pattern.sub(_wrap_link_cdata, text)
-
-        episode_tree = ET.ElementTree(ET.fromstring(fixed))
-
-    episode_root = episode_tree.getroot()
+        episode_root = fromstring(episode_data, parser=_PARSER)
+    except XMLSyntaxError:
+        fixed = _fix_links(episode_data.decode("utf-8"))
+        episode_root = fromstring(fixed.encode("utf-8"), parser=_PARSER)
 
     # Extract item from episode XML and insert at the beginning of channel
     # If the episode XML file's root is itself an <item>, include it.
@@ -117,106 +176,86 @@ def merge_episode_into_feed(feed_file: Path, episode_file: Path) -> bytes:
         # a single <item> as the document element are used (common in this
         # project). findall(".//item") does not return the root element.
         new_items = [episode_root] + new_items
-    existing_items = channel.findall("item")
-
-    # Get existing GUIDs and links to check for duplicates
-    existing_guids = set()
-    existing_links = set()
-    for item in existing_items:
-        guid = item.find("guid")
-        link = item.find("link")
-        if guid is not None and guid.text:
-            existing_guids.add(guid.text)
-        if link is not None and link.text:
-            existing_links.add(link.text)
-
-    # Add only non-duplicate new items
+
+    # Check new items against the index in a single pass: an item is a
+    # duplicate if its guid (or, lacking one, its link) was already seen in
+    # the feed or earlier in this batch
     items_to_keep = []
     for item in new_items:
-        guid = item.find("guid")
-        link = item.find("link")
-        is_duplicate = False
-
-        if guid is not None and guid.text:
-            if guid.text in existing_guids:
-                is_duplicate = True
-        elif link is not None and link.text:
-            if link.text in existing_links:
-                is_duplicate = True
-
-        if not is_duplicate:
-            items_to_keep.append(item)
-            # Add to sets to catch duplicates within new items
-            if guid is not None and guid.text:
-                existing_guids.add(guid.text)
-            if link is not None and link.text:
-                existing_links.add(link.text)
-
-    # Clear channel
-    for item in existing_items:
-        channel.remove(item)
-
-    # Add non-duplicate new items first
-    for item in items_to_keep:
-        channel.append(item)
-
-    # Add back existing items
-    for item in existing_items:
-        channel.append(item)
-
-    # Pretty-print with namespace preservation
-    raw = ET.tostring(rss, encoding="utf-8", xml_declaration=True)
-    parsed = minidom.parseString(raw)
-    
-    def fix_namespace_prefixes(node):
-        """Recursively fix namespace prefixes to match original names"""
-        if node.nodeType == Node.ELEMENT_NODE and ':' in node.tagName:
-            prefix = node.tagName.split(':')[0]
-            if node.prefix != prefix:
-                node.prefix = prefix
-        for child in node.childNodes:
-            fix_namespace_prefixes(child)
-    
-    # First fix namespace prefixes
-    fix_namespace_prefixes(parsed.documentElement)
-    
-    # Then handle CDATA sections for links
-    for link_node in parsed.getElementsByTagName("link"):
-        parent = link_node.parentNode
-        if parent is None or parent.nodeName != "item":
+        guid, link = _item_keys(item)
+        key = guid or link
+        if key and key in index:
             continue
-            
-        text_parts = []
-        for child in list(link_node.childNodes):
-            if child.nodeType in (Node.TEXT_NODE, Node.CDATA_SECTION_NODE):
-                text_parts.append(child.data)
-            link_node.removeChild(child)
-            
-        text = "".join(text_parts)
-        cdata = parsed.createCDATASection(text)
-        link_node.appendChild(cdata)
-
-        # Collect existing text content (including any CDATA) then remove children
-        text_parts = []
-        for child in list(link_node.childNodes):
-            if child.nodeType in (Node.TEXT_NODE, Node.CDATA_SECTION_NODE):
-                text_parts.append(child.data)
-            link_node.removeChild(child)
-
-        text = "".join(text_parts)
-        cdata = parsed.createCDATASection(text)
-        link_node.appendChild(cdata)
-
-    pretty = parsed.toprettyxml(indent="  ", encoding="utf-8")
-    # Remove empty lines
-    compact = b"\n".join([line for line in pretty.splitlines() if line.strip()])
-    return compact
+        items_to_keep.append(item)
+        index.update(key for key in (guid, link) if key)
+
+    # Wrap new item links in CDATA (download URLs routinely carry '&'). Links
+    # of existing items keep the CDATA sections they were parsed with.
+    for item in items_to_keep:
+        link_node = item.find("link")
+        if link_node is not None:
+            link_node.text = CDATA(link_node.text or "")
+
+    # Rebuild the channel in a single slice assignment: channel metadata,
+    # then non-duplicate new items, then the existing items
+    children = list(channel)
+    channel[:] = (
+        [child for child in children if child.tag != "item"]
+        + items_to_keep
+        + [child for child in children if child.tag == "item"]
+    )
+
+    # Indent in place rather than relying on pretty_print, which leaves any
+    # whitespace carried over from the source files as-is
+    indent(rss, space="  ")
+
+    # Serialize straight to a sibling temp file, then swap it into place so
+    # readers never see a partially written feed. A failed write leaves the
+    # previous feed untouched and removes the temp file.
+    tmp_path = out_path.with_suffix(out_path.suffix + ".tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            ElementTree(rss).write(f, xml_declaration=True, encoding="utf-8")
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def update_feed(feed_file: Path, episode_file: Path, hash_file: Path) -> bool:
+    # Merge the episode into the feed unless this exact episode was already
+    # merged into this exact feed, and return whether the feed was written.
+    # hash_file records the digests of the last merged episode and of the
+    # feed that merge produced, so a feed replaced since then (e.g. reverted
+    # in git) is merged again. File mtimes are not usable here: CI checkouts
+    # reset them.
+    episode_data = episode_file.read_bytes()
+    episode_hash = hashlib.sha256(episode_data).hexdigest()
+    try:
+        recorded = hash_file.read_text(encoding="utf-8").split()
+        feed_hash = hashlib.sha256(feed_file.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        pass
+    else:
+        if recorded == [episode_hash, feed_hash]:
+            return False
+
+    # Ensure output directory exists
+    feed_file.parent.mkdir(parents=True, exist_ok=True)
+
+    # Merge episode into feed and write it in place
+    merge_episode_into_feed(feed_file, episode_data, feed_file)
+    feed_hash = hashlib.sha256(feed_file.read_bytes()).hexdigest()
+    hash_file.write_text(f"{episode_hash} {feed_hash}\n", encoding="utf-8")
+    return True
 
 
 def main() -> None:
     repo_root = Path(__file__).resolve().parents[1]
     data_dir = repo_root / "data"
     feed_file = repo_root / "docs" / "feed.xml"
+    # Kept out of docs/ so it is not published with the site
+    hash_file = data_dir / ".feed.hash"
 
     # Find the latest episode file
     episode_file = get_latest_episode_file(data_dir)
@@ -224,15 +263,9 @@ def main() -> None:
         print("No episode file found in data directory")
         return
 
-    # Merge episode into feed
-    xml_bytes = merge_episode_into_feed(feed_file, episode_file)
-
-    # Ensure output directory exists
-    feed_file.parent.mkdir(parents=True, exist_ok=True)
-
-    # Write updated feed
-    with open(feed_file, "wb") as f:
-        f.write(xml_bytes)
+    if not update_feed(feed_file, episode_file, hash_file):
+        print(f"Feed already includes {episode_file.name}, nothing to do")
+        return
 
     print(f"Wrote RSS feed to: {feed_file}")
 
@@ -2,8 +2,11 @@ import unittest
 from pathlib import Path
 import xml.etree.ElementTree as ET
 import tempfile
+from unittest import mock
 
-from scripts.generate_feed import merge_episode_into_feed
+from lxml.etree import XMLSyntaxError
+
+from scripts.generate_feed import _fix_links, get_latest_episode_file, merge_episode_into_feed, update_feed
 
 class TestGenerateFeed(unittest.TestCase):
     def test_episode_xml_parsing(self):
@@ -38,10 +41,10 @@ class TestGenerateFeed(unittest.TestCase):
 
         try:
             # This should not raise an exception if XML is well-formed
-            xml_bytes = merge_episode_into_feed(feed_path, episode_path)
+            merge_episode_into_feed(feed_path, episode_path.read_bytes(), feed_path)
             
             # Verify the output can be parsed
-            parsed = ET.fromstring(xml_bytes.decode('utf-8'))
+            parsed = ET.parse(feed_path).getroot()
             
             # Check if the new item was merged
             channel = parsed.find('channel')
@@ -57,12 +60,12 @@ class TestGenerateFeed(unittest.TestCase):
             feed_path.unlink()
 
     def test_invalid_episode_xml(self):
-        # Create a temporary episode file with invalid XML structure
+        # Create a temporary episode file with an unclosed <description>
         with tempfile.NamedTemporaryFile(mode='w', suffix='.xml', delete=False) as episode_file:
             episode_file.write('''<item>
       <title>TechNewsDaily — Invalid Episode</title>
       <link>https://example.com/test</link>
-      <description>Invalid episode description</description>
+      <description>Invalid episode description
       <pubDate>2025-11-06</pubDate>
       <guid>test-episode-invalid</guid>
 </item>
@@ -70,12 +73,187 @@ class TestGenerateFeed(unittest.TestCase):
             episode_path = Path(episode_file.name)
 
         try:
-            # This should raise an exception due to missing XML declaration and root element
-            with self.assertRaises(ET.ParseError):
-                merge_episode_into_feed(Path('dummy.xml'), episode_path)
+            # Malformed episodes surface lxml's XMLSyntaxError
+            with tempfile.TemporaryDirectory() as tmp, self.assertRaises(XMLSyntaxError):
+                merge_episode_into_feed(Path('dummy.xml'), episode_path.read_bytes(), Path(tmp) / 'feed.xml')
         finally:
             # Clean up temporary file
             episode_path.unlink()
 
+    def test_new_feed_declares_namespaces(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            episode_path = Path(tmp) / 'episode-1.xml'
+            episode_path.write_text('<item><title>First</title><guid>first</guid></item>', encoding='utf-8')
+            feed_path = Path(tmp) / 'feed.xml'
+
+            merge_episode_into_feed(feed_path, episode_path.read_bytes(), feed_path)
+
+            header = feed_path.read_text(encoding='utf-8').splitlines()[1]
+            self.assertIn('xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd"', header)
+            self.assertNotIn(' itunes=', header)
+
+    def test_duplicate_items_are_skipped(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            feed_path = Path(tmp) / 'feed.xml'
+            feed_path.write_text('''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+    <channel>
+        <title>TechNewsDaily</title>
+        <item><title>Existing</title><guid>episode-1</guid></item>
+    </channel>
+</rss>
+''', encoding='utf-8')
+            episode_path = Path(tmp) / 'episode-2.xml'
+            episode_path.write_text('''<rss version="2.0">
+    <item><title>Resent</title><guid>episode-1</guid></item>
+    <item><title>New</title><guid>episode-2</guid></item>
+    <item><title>New again</title><guid>episode-2</guid></item>
+</rss>
+''', encoding='utf-8')
+
+            merge_episode_into_feed(feed_path, episode_path.read_bytes(), feed_path)
+
+            items = ET.parse(feed_path).getroot().find('channel').findall('item')
+            self.assertEqual([item.findtext('title') for item in items], ['New', 'Existing'])
+
+    def test_duplicate_link_without_guid_is_skipped(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            feed_path = Path(tmp) / 'feed.xml'
+            feed_path.write_text('''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+    <channel>
+        <title>TechNewsDaily</title>
+        <item><title>Existing</title><link>https://example.com/1</link><guid>episode-1</guid></item>
+    </channel>
+</rss>
+''', encoding='utf-8')
+            episode_path = Path(tmp) / 'episode-2.xml'
+            episode_path.write_text('''<rss version="2.0">
+    <item><title>Resent by link</title><link>https://example.com/1</link></item>
+    <item><title>New</title><link>https://example.com/2</link><guid>episode-2</guid></item>
+    <item><title>New by link</title><link>https://example.com/2</link></item>
+</rss>
+''', encoding='utf-8')
+
+            merge_episode_into_feed(feed_path, episode_path.read_bytes(), feed_path)
+
+            items = ET.parse(feed_path).getroot().find('channel').findall('item')
+            self.assertEqual([item.findtext('title') for item in items], ['New', 'Existing'])
+
+    def test_only_new_item_links_are_wrapped_in_cdata(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            feed_path = Path(tmp) / 'feed.xml'
+            feed_path.write_text('''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+    <channel>
+        <title>TechNewsDaily</title>
+        <link>/</link>
+        <item><title>Archived</title><link><![CDATA[https://example.com/?a=1&b=2]]></link><guid>episode-1</guid></item>
+        <item><title>Plain</title><link>https://example.com/plain</link><guid>episode-0</guid></item>
+    </channel>
+</rss>
+''', encoding='utf-8')
+            episode_path = Path(tmp) / 'episode-2.xml'
+            episode_path.write_text(
+                '<item><title>New</title><link>https://example.com/?c=3&d=4</link><guid>episode-2</guid></item>',
+                encoding='utf-8',
+            )
+
+            merge_episode_into_feed(feed_path, episode_path.read_bytes(), feed_path)
+
+            output = feed_path.read_text(encoding='utf-8')
+            self.assertIn('<link><![CDATA[https://example.com/?c=3&d=4]]></link>', output)
+            self.assertIn('<link><![CDATA[https://example.com/?a=1&b=2]]></link>', output)
+            self.assertIn('<link>https://example.com/plain</link>', output)
+            self.assertIn('<link>/</link>', output)
+
+    def test_update_feed_skips_already_merged_episode(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            episode_path = Path(tmp) / 'episode-1.xml'
+            episode_path.write_text('<item><title>First</title><guid>first</guid></item>', encoding='utf-8')
+            feed_path = Path(tmp) / 'docs' / 'feed.xml'
+            hash_path = Path(tmp) / '.feed.hash'
+
+            self.assertTrue(update_feed(feed_path, episode_path, hash_path))
+            self.assertTrue(hash_path.exists())
+            written = feed_path.read_bytes()
+            mtime = feed_path.stat().st_mtime_ns
+
+            self.assertFalse(update_feed(feed_path, episode_path, hash_path))
+            self.assertEqual(feed_path.read_bytes(), written)
+            self.assertEqual(feed_path.stat().st_mtime_ns, mtime)
+
+    def test_failed_write_keeps_previous_feed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            feed_path = Path(tmp) / 'feed.xml'
+            feed_path.write_text('''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+    <channel>
+        <title>TechNewsDaily</title>
+    </channel>
+</rss>
+''', encoding='utf-8')
+            previous = feed_path.read_bytes()
+            episode_path = Path(tmp) / 'episode-1.xml'
+            episode_path.write_text('<item><title>First</title><guid>first</guid></item>', encoding='utf-8')
+
+            with mock.patch('scripts.generate_feed.ElementTree') as tree:
+                tree.return_value.write.side_effect = OSError('disk full')
+                with self.assertRaises(OSError):
+                    merge_episode_into_feed(feed_path, episode_path.read_bytes(), feed_path)
+
+            self.assertEqual(feed_path.read_bytes(), previous)
+            self.assertFalse((Path(tmp) / 'feed.xml.tmp').exists())
+
+    def test_update_feed_merges_again_when_feed_was_replaced(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            episode_path = Path(tmp) / 'episode-2.xml'
+            episode_path.write_text('<item><title>Second</title><guid>second</guid></item>', encoding='utf-8')
+            feed_path = Path(tmp) / 'docs' / 'feed.xml'
+            feed_path.parent.mkdir()
+            feed_path.write_text('''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+    <channel>
+        <title>TechNewsDaily</title>
+        <item><title>First</title><guid>first</guid></item>
+    </channel>
+</rss>
+''', encoding='utf-8')
+            previous = feed_path.read_bytes()
+            hash_path = Path(tmp) / '.feed.hash'
+
+            self.assertTrue(update_feed(feed_path, episode_path, hash_path))
+
+            # Restore the old feed but keep the sidecar from the first merge
+            feed_path.write_bytes(previous)
+            self.assertTrue(update_feed(feed_path, episode_path, hash_path))
+
+            items = ET.parse(feed_path).getroot().find('channel').findall('item')
+            self.assertEqual([item.findtext('title') for item in items], ['Second', 'First'])
+
+    def test_fix_links_wraps_bare_ampersand(self):
+        text = (
+            '<item><link>https://example.com/a</link></item>'
+            '<item><link>https://example.com/?a=1&b=2</link></item>'
+            '<item><link>https://example.com/?a=1&amp;b=2</link></item>'
+            '<item><link><![CDATA[https://example.com/?c=3&d=4]]></link></item>'
+        )
+        self.assertEqual(
+            _fix_links(text),
+            '<item><link>https://example.com/a</link></item>'
+            '<item><link><![CDATA[https://example.com/?a=1&b=2]]></link></item>'
+            '<item><link>https://example.com/?a=1&amp;b=2</link></item>'
+            '<item><link><![CDATA[https://example.com/?c=3&d=4]]></link></item>'
+        )
+
+    def test_get_latest_episode_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data_dir = Path(tmp)
+            for name in ('episode-100.xml', 'eposide-250.xml', 'episode-latest.xml', 'notes-900.xml'):
+                (data_dir / name).touch()
+
+            self.assertEqual(get_latest_episode_file(data_dir), data_dir / 'eposide-250.xml')
+            self.assertIsNone(get_latest_episode_file(data_dir / 'missing'))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file